@@ -46,6 +46,10 @@ def main():
                    help='Listen address for discovery')
     p.add_argument('--reconnect', action='store_true', default=False,
                    help='Attempt to (re)connect forever')
+    p.add_argument('--pushall-interval', type=int,
+                   default=printer.PUSHALL_MIN_INTERVAL,
+                   help=('Minimum seconds between full status requests '
+                         '(default %(default)s)'))
     p.add_argument('-v', '--verbose', action='store_true', default=False,
                    help='Log verbosely')
     p.add_argument('--debug', action='store_true', default=False,
@@ -83,7 +87,8 @@ def main():
 
     try:
         pr = printer.Printer(args.host, args.key, args.device,
-                             reconnect=args.reconnect)
+                             reconnect=args.reconnect,
+                             pushall_interval=args.pushall_interval)
     except OSError as e:
         print('Failed to connect to %s: %s' % (args.host, e))
         return 1
@@ -103,4 +108,6 @@ def main():
     except KeyboardInterrupt:
         pass
     finally:
+        LOG.info('Full status requests: %(sent)i sent, %(avoided)i avoided',
+                 pr.pushall_stats)
         pr.client.disconnect()
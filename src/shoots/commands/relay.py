@@ -0,0 +1,216 @@
+import argparse
+import json
+import logging
+import threading
+import time
+
+import paho.mqtt.client as mqtt
+
+from shoots import cli
+from shoots import printer
+
+LOG = logging.getLogger(__name__)
+
+# These change on every message and would defeat deduplication
+VOLATILE = ('sequence_id',)
+
+
+def flatten(data, prefix=()):
+    """Flatten nested dicts into {(path, elements): value}.
+
+    Lists are treated as opaque values and compared as a whole.
+    """
+    flat = {}
+    for k, v in data.items():
+        if k in VOLATILE:
+            continue
+        path = prefix + (str(k),)
+        if isinstance(v, dict):
+            flat.update(flatten(v, path))
+        else:
+            flat[path] = v
+    return flat
+
+
+def unflatten(flat):
+    """Rebuild nested dicts from the output of flatten()."""
+    data = {}
+    for path, value in flat.items():
+        d = data
+        for element in path[:-1]:
+            d = d.setdefault(element, {})
+        d[path[-1]] = value
+    return data
+
+
+class Relay(cli.ShootsCommand):
+    def add_args(self, subparsers: argparse._SubParsersAction):
+        p = subparsers.add_parser(
+            'relay',
+            help='Share one printer connection via a local MQTT broker')
+        p.add_argument('--broker', default='localhost',
+                       help='Local MQTT broker to republish to')
+        p.add_argument('--broker-port', type=int, default=1883,
+                       help='Local MQTT broker port')
+        p.add_argument('--broker-user', default=None,
+                       help='Username for the local broker')
+        p.add_argument('--broker-password', default=None,
+                       help='Password for the local broker')
+        p.add_argument('--prefix', default='shoots',
+                       help='Topic prefix on the local broker')
+
+    def topic(self, *parts):
+        return '/'.join((self._prefix, self._device) + parts)
+
+    def publish_state(self, flat):
+        for path, value in flat.items():
+            self._local.publish(self.topic('state', *path),
+                                json.dumps(value), retain=True)
+
+    def reply_pushall(self):
+        # Answer consumers waiting for a full report once our own state is
+        # known to be complete, each on their own reply topic
+        with self._lock:
+            if (not self._waiters or not self._complete or
+                    not self._printer.state_current):
+                return
+            waiters, self._waiters = self._waiters, {}
+            report = json.dumps(unflatten(self._state))
+        for topic in waiters:
+            self._local.publish(topic, report)
+        LOG.debug('Answered %i pushall requests from cache', len(waiters))
+
+    def on_report(self, topic, data):
+        if topic != 'report':
+            return
+
+        if data.get('print', {}).get('command') != 'push_status':
+            # Replies to commands (and info) are events, not state, so pass
+            # them through untouched for consumers to match by sequence_id
+            self._local.publish(self.topic('reply'), json.dumps(data))
+            return
+
+        flat = flatten({'print': data['print']})
+        changed = {path: value for path, value in flat.items()
+                   if path not in self._state or self._state[path] != value}
+        if changed:
+            with self._lock:
+                self._state.update(changed)
+            self.publish_state(changed)
+
+            # Also provide the changed paths as a single (nested) delta
+            self._local.publish(self.topic('report'),
+                                json.dumps(unflatten(changed)))
+            LOG.debug('Relayed %i changed paths', len(changed))
+        else:
+            LOG.debug('Report had no changes')
+
+        with self._lock:
+            # Only now has the report making the printer current been merged
+            self._complete = self._printer.state_current
+        self.reply_pushall()
+
+    def expire_waiter(self, topic):
+        now = time.monotonic()
+        with self._lock:
+            # It may have been answered, or asked for again since
+            deadline = self._waiters.get(topic)
+            if deadline is None or deadline > now:
+                return
+            del self._waiters[topic]
+        LOG.warning('No full report in time, dropped pushall for %s', topic)
+
+    def on_local_connect(self, client, userdata, flags, rc):
+        if rc != 0:
+            LOG.warning('Local broker connection failed with code %i', rc)
+            return
+        LOG.info('Connected to local broker %s:%i',
+                 self._args.broker, self._args.broker_port)
+        client.publish(self.topic('online'), 'true', retain=True)
+        client.subscribe(self.topic('request', '#'))
+        # The broker may have lost our retained state if it restarted
+        with self._lock:
+            state = dict(self._state)
+        self.publish_state(state)
+
+    def on_local_message(self, client, userdata, msg):
+        payload = msg.payload
+        if payload.endswith(b'\x00'):
+            payload = payload[:-1]
+        try:
+            data = json.loads(payload)
+        except ValueError:
+            LOG.warning('Ignoring non-JSON request: %r', msg.payload)
+            return
+        if not isinstance(data, dict):
+            LOG.warning('Ignoring non-object request: %r', data)
+            return
+
+        if (isinstance(data.get('pushing'), dict) and
+                data['pushing'].get('command') == 'pushall'):
+            # Only ask the printer if the coordinator thinks we need it,
+            # and answer from our state once it is known to be complete
+            reply = msg.topic.replace(self.topic('request'),
+                                      self.topic('reply'), 1)
+            with self._lock:
+                self._waiters[reply] = (time.monotonic() +
+                                        printer.PUSHALL_TIMEOUT)
+            timer = threading.Timer(printer.PUSHALL_TIMEOUT,
+                                    self.expire_waiter, args=(reply,))
+            timer.daemon = True
+            timer.start()
+            try:
+                self._printer.pushall()
+            except printer.NotReady:
+                pass
+            self.reply_pushall()
+            return
+
+        try:
+            self._printer.send_raw(data)
+        except printer.NotReady:
+            LOG.warning('Printer not ready, dropping request %r', data)
+        else:
+            LOG.info('Forwarded request %s', ','.join(data.keys()))
+
+    def execute(self, args: argparse.Namespace, p: printer.Printer):
+        self._args = args
+        self._printer = p
+        self._prefix = args.prefix
+        self._device = p.device
+        self._state = {}
+        self._waiters = {}
+        self._complete = False
+        self._lock = threading.Lock()
+
+        self._local = mqtt.Client(mqtt.CallbackAPIVersion.VERSION1)
+        self._local.enable_logger()
+        self._local.on_connect = self.on_local_connect
+        self._local.on_message = self.on_local_message
+        if args.broker_user:
+            self._local.username_pw_set(args.broker_user,
+                                        args.broker_password)
+        self._local.will_set(self.topic('online'), 'false', retain=True)
+        try:
+            self._local.connect(args.broker, args.broker_port, 60)
+        except OSError as e:
+            print('Failed to connect to broker %s: %s' % (args.broker, e))
+            return 1
+        self._local.loop_start()
+
+        p.add_listener(self.on_report)
+        # The device may have been identified before we started listening,
+        # in which case the initial full report has already gone by
+        try:
+            p.pushall(force=True)
+        except printer.NotReady:
+            pass
+
+        try:
+            while p.state.get('_connected') is not False:
+                p.wait()
+        finally:
+            self._local.publish(self.topic('online'), 'false', retain=True)
+            self._local.disconnect()
+            self._local.loop_stop()
+        return 255
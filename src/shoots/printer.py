@@ -5,6 +5,7 @@ import logging
 import pprint
 import ssl
 import threading
+import time
 
 import paho.mqtt.client as mqtt
 
@@ -18,6 +19,16 @@ STAGES = {
     PRINT_STAGE_PAUSED: 'Paused',
 }
 
+# Minimum seconds between full status requests, and how long to wait for
+# one to be answered before considering it lost
+PUSHALL_MIN_INTERVAL = 30
+PUSHALL_TIMEOUT = 10
+# Keys we expect in any full status report
+PUSHALL_KEYS = ('mc_print_stage', 'mc_percent', 'nozzle_temper')
+# Sequence gaps in a row (without a consecutive report in between) before we
+# decide the printer does not number its reports consecutively
+PUSHALL_MAX_GAPS = 3
+
 LOG = logging.getLogger(__name__)
 
 
@@ -62,8 +73,180 @@ class ImplicitFTP_TLS(ftplib.FTP_TLS):
         return (self.host if self.ignore_PASV_host else host), port
 
 
+class PushallCoordinator:
+    """Decide when a full status report (pushall) is actually needed.
+
+    The printer sends incremental reports on its own, so we only need to
+    ask for everything when our copy is known to be stale: on (re)connect,
+    on a forward gap in the report sequence, or when expected keys are
+    missing. Requests are deduplicated while one is in flight and
+    rate-limited; a resync deferred by the rate limit is sent by a timer
+    calling resync().
+
+    Our full report is recognized by it echoing the sequence_id of our
+    request. If that never happens, any report with all of PUSHALL_KEYS is
+    accepted once the request has timed out. A full report answering some
+    other client's pushall carries their sequence_id instead of the
+    printer's; if that goes backwards it is taken as a fresh full state,
+    and either way it does not count as a gap. Gap detection assumes the
+    printer numbers its push_status reports consecutively, and gives up
+    after PUSHALL_MAX_GAPS gaps in a row if that turns out not to be true.
+    """
+    def __init__(self, log, min_interval=PUSHALL_MIN_INTERVAL,
+                 timeout=PUSHALL_TIMEOUT, resync=None):
+        self.log = log
+        self._min_interval = min_interval
+        self._timeout = timeout
+        self._resync = resync
+        self._lock = threading.Lock()
+        self._timer = None
+        self._stale = True
+        self._pending = False
+        self._sent_at = None
+        self._sent_sequence = None
+        self._last_sequence = None
+        self._gaps = 0
+        self._check_gaps = True
+        self.sent = 0
+        self.avoided = 0
+
+    def _in_flight(self, now):
+        return self._pending and now - self._sent_at < self._timeout
+
+    def _rate_limited(self, now):
+        return (self._sent_at is not None and
+                now - self._sent_at < self._min_interval)
+
+    def _mark_stale(self, reason):
+        if not self._stale:
+            self.log.info('Full resync needed: %s', reason)
+        self._stale = True
+
+    def _complete(self):
+        self._pending = False
+        self._stale = False
+        self._sent_sequence = None
+        self._last_sequence = None
+
+    def _schedule(self, delay):
+        if self._resync is None or self._timer is not None:
+            return
+        self._timer = threading.Timer(delay, self._fire)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _fire(self):
+        with self._lock:
+            self._timer = None
+        if self.needed:
+            self._resync()
+
+    def reconnected(self):
+        with self._lock:
+            # Anything in flight was lost with the old connection
+            self._pending = False
+            self._stale = True
+            self._last_sequence = None
+
+    @property
+    def current(self):
+        """True if our state is complete and no resync is outstanding."""
+        with self._lock:
+            return not self._stale and not self._pending
+
+    @property
+    def needed(self):
+        """True if our state is stale and nothing in flight will fix it."""
+        with self._lock:
+            return self._stale and not self._in_flight(time.monotonic())
+
+    def request(self, sequence, force=False):
+        """Returns True if a pushall should be sent now as sequence.
+
+        With force, send even if our state looks current or we are rate
+        limited, but still not if one is already in flight. Requests that
+        are covered by current state or one in flight count as avoided;
+        rate-limited ones are deferred, not avoided.
+        """
+        with self._lock:
+            now = time.monotonic()
+            if self._in_flight(now):
+                reason = 'already in flight'
+            elif not force and not self._stale:
+                reason = 'state is current'
+            elif not force and self._rate_limited(now):
+                self.log.debug('Deferring pushall: rate limited')
+                self._schedule(self._sent_at + self._min_interval - now)
+                return False
+            else:
+                self._pending = True
+                self._sent_at = now
+                self._sent_sequence = str(sequence)
+                self.sent += 1
+                # Check again once this has had time to be answered
+                self._schedule(max(self._min_interval, self._timeout))
+                return True
+            self.avoided += 1
+            self.log.debug('Skipping pushall: %s', reason)
+            return False
+
+    def saw_report(self, print_data, state):
+        with self._lock:
+            now = time.monotonic()
+            full = all(k in print_data for k in PUSHALL_KEYS)
+            try:
+                sequence = int(print_data['sequence_id'])
+            except (KeyError, ValueError):
+                sequence = None
+
+            if full and self._pending and (
+                    str(print_data.get('sequence_id')) == self._sent_sequence
+                    or not self._in_flight(now)):
+                # Our full report, or the best we will get if it was lost
+                self._complete()
+                return
+
+            if not self._pending and not all(k in state
+                                             for k in PUSHALL_KEYS):
+                self._mark_stale('missing keys')
+
+            if sequence is None:
+                return
+
+            if (self._last_sequence is not None and
+                    sequence <= self._last_sequence):
+                # Not the printer's numbering, most likely a full report
+                # answering someone else's pushall
+                if full:
+                    self.log.debug('Saw a foreign full report')
+                    self._stale = False
+                self._last_sequence = None
+                return
+
+            if full:
+                # May carry someone else's sequence_id, so don't let it
+                # drive gap tracking
+                return
+
+            if (self._check_gaps and self._last_sequence is not None and
+                    sequence > self._last_sequence + 1):
+                self._gaps += 1
+                if self._gaps >= PUSHALL_MAX_GAPS:
+                    self._check_gaps = False
+                    self.log.warning('Reports are not numbered '
+                                     'consecutively, ignoring sequence gaps')
+                else:
+                    self._mark_stale('sequence %i -> %i' % (
+                        self._last_sequence, sequence))
+            elif self._last_sequence is not None:
+                self._gaps = 0
+
+            self._last_sequence = sequence
+
+
 class Printer:
-    def __init__(self, host, key, device, reconnect=False):
+    def __init__(self, host, key, device, reconnect=False,
+                 pushall_interval=PUSHALL_MIN_INTERVAL):
         self._host = host
         self._key = key
         self._device = device
@@ -71,11 +254,16 @@ class Printer:
         self._state = {}
         self._condition = threading.Condition()
         self._sequence = 0
+        self._sequence_lock = threading.Lock()
         if self._device:
             self.log = LOG.getChild(self._device)
         else:
             self.log = LOG
         self._ftp = None
+        self._listeners = []
+        self._pushall = PushallCoordinator(self.log,
+                                           min_interval=pushall_interval,
+                                           resync=self._resync)
 
         self.client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION1)
         self.client.enable_logger()
@@ -106,6 +294,11 @@ class Printer:
     def state(self):
         return self._state
 
+    @property
+    def pushall_stats(self):
+        return {'sent': self._pushall.sent,
+                'avoided': self._pushall.avoided}
+
     @property
     def print_stage(self):
         try:
@@ -144,25 +337,58 @@ class Printer:
 
         client.subscribe("#")
 
+        self._pushall.reconnected()
         try:
             self.pushall()
         except NotReady:
             pass
 
-    def send(self, top, command, data):
+    def add_listener(self, listener):
+        # Called with (topic, data) for every decoded message from the printer
+        self._listeners.append(listener)
+
+    def send_raw(self, msg):
         # We can only push stuff to the device if we know its ID
         if not self._device:
             raise NotReady()
 
-        self._sequence += 1
-        msg = {top: {'command': command, 'sequence_id': self._sequence}}
-        msg[top].update(data)
         self.client.publish('device/%s/request' % self._device,
                             json.dumps(msg).encode() + b'\x00')
 
-    def pushall(self):
-        self.send('pushing', 'pushall', {'push_target': 1,
-                                         'version': 1})
+    def _next_sequence(self):
+        with self._sequence_lock:
+            self._sequence += 1
+            return self._sequence
+
+    def send(self, top, command, data, sequence=None):
+        if sequence is None:
+            sequence = self._next_sequence()
+        msg = {top: {'command': command, 'sequence_id': sequence}}
+        msg[top].update(data)
+        self.send_raw(msg)
+
+    @property
+    def state_current(self):
+        return self._pushall.current
+
+    def pushall(self, force=False):
+        # We can't send anything (or know the state) until we know the ID
+        if not self._device:
+            raise NotReady()
+        sequence = self._next_sequence()
+        sent = self._pushall.request(sequence, force=force)
+        if sent:
+            self.send('pushing', 'pushall', {'push_target': 1,
+                                             'version': 1},
+                      sequence=sequence)
+        return sent
+
+    def _resync(self):
+        # Called from the coordinator's timer for a deferred resync
+        try:
+            self.pushall()
+        except NotReady:
+            pass
 
     def info(self):
         self.send('info', 'get_version', {})
@@ -218,16 +444,23 @@ class Printer:
         if self._device is None and topic == 'report':
             self._device = printer
             self.log = LOG.getChild(self._device)
-            if not self._state:
-                self.pushall()
+            self._pushall.log = self.log
+            self.pushall()
             self.log.info('Determined printer device ID to be %s',
                           self._device)
 
+        changed = None
         if topic == 'report' and 'print' in data:
-            return self._process_report_print(data)
+            changed = self._process_report_print(data)
         elif topic == 'report' and 'info' in data:
             self._process_report_info(data)
 
+        # Listeners see the message after we have processed it
+        for listener in self._listeners:
+            listener(topic, data)
+
+        return changed
+
     def _process_report_info(self, data):
         data = data['info']
         if data['command'] == 'get_version':
@@ -266,6 +499,10 @@ class Printer:
                 'remain_eta': eta,
             })
 
+        self._pushall.saw_report(print_data, self._state)
+        if self._pushall.needed:
+            self.pushall()
+
         return new_data
 
     def on_message(self, client, userdata, msg):
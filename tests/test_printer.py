@@ -0,0 +1,173 @@
+import logging
+import unittest
+from unittest import mock
+
+from shoots import printer
+
+FULL = {'mc_print_stage': '1', 'mc_percent': 0, 'nozzle_temper': 20}
+
+
+def report(sequence, **data):
+    data['sequence_id'] = str(sequence)
+    return data
+
+
+class TestPushallCoordinator(unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+        self.now = 1000.0
+        clock = mock.patch.object(printer.time, 'monotonic',
+                                  side_effect=lambda: self.now)
+        clock.start()
+        self.addCleanup(clock.stop)
+        timer = mock.patch.object(printer.threading, 'Timer')
+        self.timer = timer.start()
+        self.addCleanup(timer.stop)
+        self.resync = mock.MagicMock()
+        self.c = printer.PushallCoordinator(logging.getLogger(__name__),
+                                            min_interval=30, timeout=10,
+                                            resync=self.resync)
+
+    def sync(self, sequence=1):
+        # Request and receive our own full report
+        self.assertTrue(self.c.request(sequence))
+        self.c.saw_report(report(sequence, **FULL), FULL)
+        self.assertTrue(self.c.current)
+
+    def test_initially_stale(self):
+        self.assertFalse(self.c.current)
+        self.assertTrue(self.c.needed)
+        self.assertTrue(self.c.request(1))
+
+    def test_in_flight_dedup(self):
+        self.assertTrue(self.c.request(1))
+        self.assertFalse(self.c.request(2))
+        self.assertFalse(self.c.request(3, force=True))
+        self.assertFalse(self.c.needed)
+        self.assertEqual(1, self.c.sent)
+        self.assertEqual(2, self.c.avoided)
+
+    def test_own_reply_recognized(self):
+        self.c.request(7)
+        self.c.saw_report(report(500, nozzle_temper=20), {})
+        self.assertFalse(self.c.current)
+        self.c.saw_report(report(7, **FULL), FULL)
+        self.assertTrue(self.c.current)
+
+    def test_incremental_with_full_keys_is_not_our_reply(self):
+        self.c.request(7)
+        self.c.saw_report(report(500, **FULL), FULL)
+        self.assertFalse(self.c.current)
+
+    def test_timed_out_accepts_full_keys(self):
+        self.c.request(7)
+        self.now += 11
+        self.c.saw_report(report(500, nozzle_temper=20), {})
+        self.assertFalse(self.c.current)
+        self.c.saw_report(report(501, **FULL), FULL)
+        self.assertTrue(self.c.current)
+
+    def test_current_is_avoided(self):
+        self.sync()
+        self.assertFalse(self.c.request(2))
+        self.assertEqual(1, self.c.sent)
+        self.assertEqual(1, self.c.avoided)
+
+    def test_rate_limit_defers(self):
+        self.sync()
+        self.c.reconnected()
+        self.assertFalse(self.c.request(2))
+        # Deferred (the timer will send it), not avoided
+        self.assertEqual(0, self.c.avoided)
+        self.assertTrue(self.c.needed)
+        self.now += 30
+        self.assertTrue(self.c.request(3))
+        self.assertEqual(2, self.c.sent)
+
+    def test_timer_resyncs(self):
+        self.c.request(1)
+        delay, fire = self.timer.call_args[0]
+        self.assertEqual(30, delay)
+        self.now += 30
+        fire()
+        # Never answered, so still needed
+        self.resync.assert_called_once_with()
+
+    def test_timer_skips_when_current(self):
+        self.sync()
+        fire = self.timer.call_args[0][1]
+        self.now += 30
+        fire()
+        self.resync.assert_not_called()
+
+    def test_force(self):
+        self.sync()
+        self.assertTrue(self.c.request(2, force=True))
+        self.assertEqual(2, self.c.sent)
+
+    def test_sequence_gap(self):
+        self.sync()
+        self.c.saw_report(report(500), FULL)
+        self.c.saw_report(report(501), FULL)
+        self.assertTrue(self.c.current)
+        self.c.saw_report(report(505), FULL)
+        self.assertFalse(self.c.current)
+        self.assertTrue(self.c.needed)
+
+    def test_repeated_gaps_disable_gap_check(self):
+        self.sync()
+        self.c.saw_report(report(500), FULL)
+        for i in range(printer.PUSHALL_MAX_GAPS - 1):
+            self.c.saw_report(report(510 + i * 10), FULL)
+        self.now += 30
+        self.sync(2)
+        self.c.saw_report(report(600), FULL)
+        self.c.saw_report(report(610), FULL)
+        self.assertTrue(self.c.current)
+
+    def test_consecutive_resets_gap_count(self):
+        self.sync()
+        for sequence in (500, 510, 511, 520):
+            self.c.saw_report(report(sequence), FULL)
+        self.now += 30
+        self.sync(2)
+        self.c.saw_report(report(600), FULL)
+        self.c.saw_report(report(610), FULL)
+        self.assertFalse(self.c.current)
+
+    def test_missing_keys(self):
+        self.sync()
+        self.c.saw_report(report(500), {'nozzle_temper': 20})
+        self.assertFalse(self.c.current)
+
+    def test_foreign_full_report(self):
+        self.sync()
+        for sequence in (500, 501, 502):
+            self.c.saw_report(report(sequence), FULL)
+        self.c.saw_report(report(0, **FULL), FULL)
+        self.assertTrue(self.c.current)
+        # Gap tracking starts over from the printer's next report
+        self.c.saw_report(report(503), FULL)
+        self.c.saw_report(report(504), FULL)
+        self.assertTrue(self.c.current)
+
+    def test_foreign_full_report_clears_stale(self):
+        self.sync()
+        self.c.saw_report(report(500), FULL)
+        self.c.saw_report(report(505), FULL)
+        self.assertFalse(self.c.current)
+        self.c.saw_report(report(0, **FULL), FULL)
+        self.assertTrue(self.c.current)
+
+    def test_reconnect(self):
+        self.sync()
+        self.c.saw_report(report(500), FULL)
+        self.c.reconnected()
+        self.assertFalse(self.c.current)
+        self.now += 30
+        self.assertTrue(self.c.request(2))
+        # The printer's numbering may have restarted
+        self.c.saw_report(report(2, **FULL), FULL)
+        self.c.saw_report(report(1), FULL)
+        self.c.saw_report(report(2), FULL)
+        self.assertTrue(self.c.current)